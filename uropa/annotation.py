@@ -1,11 +1,24 @@
 """Contains code for the annotation process"""
 
 import pysam
-from functools import reduce
-import re
+from functools import reduce, lru_cache
+import types
 import numpy as np
 import logging
-import datetime
+import time
+
+#Numba is an optional dependency; the numpy implementation is used as fallback.
+#The import is deferred to init_jit_kernel() because importing numba takes a noticeable
+#fraction of a second, which every CLI start (including --help) would otherwise pay.
+_NUMBA_AVAILABLE = None		#resolved on the first call of init_jit_kernel()
+_score_candidates_kernel = None
+
+#ncls is an optional dependency; window lookups fall back to bisecting sorted arrays
+try:
+	from ncls import NCLS
+	_NCLS_AVAILABLE = True
+except ImportError:
+	_NCLS_AVAILABLE = False
 
 from .utils import * #import Uropa logging functions
 
@@ -27,46 +40,155 @@ def decimal_round(num, d=3):
 
 	return(rounded)
 
-def create_anno_dict(peak, hit):
-	""" Returns a dictionary containing information on the hit from gtf """
+class GTFRecord:
+	""" Lightweight in-memory GTF record mimicking the records returned by pysam.asGTF() """
+
+	__slots__ = ("start", "end", "strand", "feature", "attributes")
+
+	def __init__(self, start, end, strand, feature, attributes):
+		self.start = start			#0-based start as returned by pysam
+		self.end = end
+		self.strand = strand
+		self.feature = feature
+		self.attributes = attributes
+
+
+class ChromFeatures:
+	""" Holds all GTF records of one chromosome in memory for fast window lookups.
+
+		Fetching a whole chromosome once and bisecting into sorted coordinate arrays replaces
+		the repeated tabix fetches per peak/query, which re-parse the same GTF lines for
+		every overlapping window. """
+
+	def __init__(self, tabix_obj, chrom):
+		""" Load all records for chrom from an open pysam.TabixFile """
+
+		starts, ends, strands, features, attributes = [], [], [], [], []
+		dedup = {}	#deduplicate shared strings across records
+		try:
+			for hit in tabix_obj.fetch(chrom, parser=pysam.asGTF()):
+				starts.append(hit.start)
+				ends.append(hit.end)
+				strands.append(dedup.setdefault(hit.strand, hit.strand))
+				features.append(dedup.setdefault(hit.feature, hit.feature))
+				attributes.append(dedup.setdefault(hit.attributes, hit.attributes))
+		except ValueError:
+			pass	#contig does not exist in the gtf index; chromosome is left empty
+
+		self.n = len(starts)
+		self.starts = np.array(starts, dtype=np.int32)		#sorted; tabix-indexed gtfs are sorted by start
+		self.ends = np.array(ends, dtype=np.int32)
+		self.max_ends = np.maximum.accumulate(self.ends) if self.n > 0 else self.ends 	#running max of ends for bisecting the lower bound
+		self.strands = strands
+		self.features = features
+		self.attributes = attributes
+
+		#Integer-coded feature names and strand flags for vectorized filtering
+		self.feature_index = {}		#feature name -> integer id
+		for name in features:
+			if name not in self.feature_index:
+				self.feature_index[name] = len(self.feature_index)
+		self.feature_ids = np.array([self.feature_index[name] for name in features], dtype=np.int32)
+		self.strand_plus = np.array([strand == "+" for strand in strands], dtype=bool)
+		self.strand_minus = np.array([strand == "-" for strand in strands], dtype=bool)
+
+		#Nested containment list for interval queries if ncls is available
+		if _NCLS_AVAILABLE and self.n > 0:
+			self.tree = NCLS(self.starts.astype(np.int64), self.ends.astype(np.int64), np.arange(self.n, dtype=np.int64))
+		else:
+			self.tree = None
+
+	def fetch_idx(self, start, end):
+		""" Returns a numpy array of record indices overlapping the window start-end (1-based
+			inclusive; same coordinates as a tabix region query) """
+
+		start0, end0 = start - 1, end 	#0-based half-open window
+
+		#Query the nested containment list if available
+		if self.tree is not None:
+			_, idx = self.tree.all_overlaps_both(np.array([start0], dtype=np.int64), np.array([end0], dtype=np.int64), np.zeros(1, dtype=np.int64))
+			idx.sort()	#restore gtf file order for downstream tie-breaking
+
+			return(idx)
+
+		#Otherwise bisect into sorted arrays to establish the candidate slice
+		hi = np.searchsorted(self.starts, end0, side="left")		#records beyond hi start after the window
+		lo = np.searchsorted(self.max_ends[:hi], start0, side="right")	#records before lo all end before the window
+
+		#Within the slice, records can still end before the window start
+		idx = lo + np.nonzero(self.ends[lo:hi] > start0)[0]
+
+		return(idx)
+
+	def record(self, i):
+		""" Returns the GTFRecord at index i """
+		return(GTFRecord(self.starts[i], self.ends[i], self.strands[i], self.features[i], self.attributes[i]))
+
+
+@lru_cache(maxsize=200000)
+def parse_attributes(attributes):
+	""" Parse the attributes column of a gtf line into a dict of lists, e.g. {"key1":[value1], "key2":[val1,val2]}.
+
+		A single transcript emits many records (transcript/exons/CDS/...) sharing the same attribute
+		string, so parsed results are cached and returned as a shared read-only mapping - each unique
+		string is only parsed once. """
+
+	#Values from identical tags are joined to lists
+	attribute_dict = {}
+	for pair in attributes.strip("; ").split(";"):	#plain str.split is faster than a regex split per hit
+		tokens = pair.split(None, 1)	#tag and value; split on first whitespace
+		if len(tokens) == 0:
+			continue
+		value = tokens[1].rstrip().replace("\"", "") if len(tokens) > 1 else ""	#rstrip to drop any whitespace before the ';'
+		attribute_dict.setdefault(tokens[0], []).append(value)
+
+	return(types.MappingProxyType(attribute_dict))	#read-only; the mapping is shared between hits
+
+
+#Cache of loaded chromosomes per worker process. Peak chunks from a sorted .bed-file mostly revisit
+#the chromosome(s) of the previous chunks, so pool workers can reuse the loaded records across jobs.
+CHROM_CACHE = {}		#(gtf_gz, chrom) -> ChromFeatures
+CHROM_CACHE_SIZE = 3	#number of chromosomes kept per worker
+
+def get_chrom_features(tabix_obj, gtf_gz, chrom):
+	""" Returns the ChromFeatures for chrom, reusing the cache of this worker process if possible """
+
+	key = (gtf_gz, chrom)
+	if key not in CHROM_CACHE:
+		if len(CHROM_CACHE) >= CHROM_CACHE_SIZE:
+			CHROM_CACHE.pop(next(iter(CHROM_CACHE)))	#evict the oldest loaded chromosome
+		CHROM_CACHE[key] = ChromFeatures(tabix_obj, chrom)
+
+	return(CHROM_CACHE[key])
+
+
+def create_anno_dict(peak, hit, peak_center, peak_length):
+	""" Returns a dictionary containing information on the hit from gtf.
+
+		peak_center/peak_length are precalculated once per peak and passed in
+		instead of being derived again for every hit. """
 
 	#Add peak information
 	anno_dict = {}
 	anno_dict.update(peak) #fills out peak chr/start/end/id/score/strand
-	anno_dict["peak_center"] = int((anno_dict["peak_end"] + anno_dict["peak_start"])/2.0)
-	anno_dict["peak_length"] = anno_dict["peak_end"] - anno_dict["peak_start"]
+	anno_dict["peak_center"] = peak_center
+	anno_dict["peak_length"] = peak_length
 
-	#Parse info from gtf string
+	#Parse info from gtf string (cached across records with identical attribute strings)
 	try:
-		att = hit.attributes.strip("; ")	#remove trailing ;
-		pairs = re.split(";\s*", att) 		#regex split on ;(space)
-
-		pairs = [pair.split() for pair in pairs]
-		attribute_tags = [pair[0] for pair in pairs]
-		attribute_values = [" ".join(pair[1:]).replace("\"", "") for pair in pairs]
-		
-		#Join values from identical tags to list
-		attribute_dict = {tag:[] for tag in attribute_tags}
-		for i, (tag, value) in enumerate(zip(attribute_tags, attribute_values)):
-			attribute_dict[tag].append(value)
-
+		attribute_dict = parse_attributes(hit.attributes)
 	except Exception as e:
 		print("Error reading attributes: {0} ({1})".format(hit.attributes, e))
 		attribute_dict = {}
 
-	# Fill in with feature info
+	# Fill in with feature info; coordinates stay in int32 as stored in ChromFeatures
 	anno_dict["feature"] = hit.feature
 	anno_dict["feat_strand"] = hit.strand
-	anno_dict["feat_start"] = int(hit.start)
-	anno_dict["feat_end"] = int(hit.end)
-	anno_dict["feat_center"] = int((anno_dict["feat_end"] + anno_dict["feat_start"])/2.0)
-	anno_dict["feat_length"] =  int(anno_dict["feat_end"] - anno_dict["feat_start"])
-	anno_dict["feat_attributes"] = attribute_dict	# Dictionary of lists containig values {"key1":[value1], "key2":[val1,val2]} 
-
-	#Look-up keys for annotation
-	anno_dict["anchor_pos"] = {"start": anno_dict["feat_start"] if anno_dict["feat_strand"] != "-" else anno_dict["feat_end"],
-								"center": anno_dict["feat_center"], 
-								"end": anno_dict["feat_end"] if anno_dict["feat_strand"] != "-" else anno_dict["feat_start"]}
+	anno_dict["feat_start"] = hit.start
+	anno_dict["feat_end"] = hit.end
+	anno_dict["feat_center"] = hit.start + (hit.end - hit.start) // 2	#avoids int32 overflow of start+end for large coordinates
+	anno_dict["feat_length"] = hit.end - hit.start
+	anno_dict["feat_attributes"] = attribute_dict	# Dictionary of lists containig values {"key1":[value1], "key2":[val1,val2]}
 
 	#Change with each query
 	anno_dict["query"] = 0	 #query for which the hit was valid
@@ -76,97 +198,217 @@ def create_anno_dict(peak, hit):
 
 
 
-def distance_to_peak_center(anno_dict, query_anchor):
-    """ Assigns the distance of peak center to best query anchor """
+def score_candidates(peak_center, chrom_feats, idx, anchor_list):
+	""" Assigns the distance of peak center to best query anchor for a whole slice of candidate records at once.
 
-    anchor_list = list(query_anchor)
+		Input:
+			peak_center (int): Center position of the peak
+			chrom_feats (ChromFeatures): The loaded gtf records for the chromosome of the peak
+			idx (np.ndarray): Indices of the candidate records within chrom_feats
+			anchor_list (list): Anchors to calculate distances to, e.g. ["start", "center", "end"]
 
-    #Set default if anchor list is empty
-    if len(query_anchor) == 0:
-    	anchor_list = ["start", "center", "end"]
+		Returns:
+			(raw_distance, distance, anchor_i): numpy arrays over the candidates; anchor_i indexes into anchor_list
+	"""
 
-    #Calculate distances to each possible anchor
-    raw_distances = [anno_dict["peak_center"] - anno_dict["anchor_pos"][anchor] for anchor in anchor_list]
-    abs_distances = [abs(dist) for dist in raw_distances]
-    min_dist_i = abs_distances.index(min(abs_distances))
+	fs = chrom_feats.starts[idx]
+	fe = chrom_feats.ends[idx]
+	minus = chrom_feats.strand_minus[idx]
 
-    #Set minimum distance as best anchor
-    anno_dict["raw_distance"] = raw_distances[min_dist_i]
-    anno_dict["distance"] = int(abs(raw_distances[min_dist_i]))
-    anno_dict["feat_anchor"] = anchor_list[min_dist_i]
+	#Positions of the possible anchors ("start"/"end" refer to the direction of transcription)
+	anchor_pos = {"start": np.where(minus, fe, fs),
+					"center": fs + (fe - fs) // 2,	#avoids int32 overflow of fs+fe for large coordinates
+					"end": np.where(minus, fs, fe)}
 
-    return(anno_dict)
+	#Calculate distances to each possible anchor; (n_anchors x n_candidates)
+	raw_distances = np.stack([peak_center - anchor_pos[anchor] for anchor in anchor_list])
+	abs_distances = np.abs(raw_distances)
 
+	#Set minimum distance as best anchor (first anchor in anchor_list wins ties)
+	anchor_i = np.argmin(abs_distances, axis=0)
+	cols = np.arange(len(idx))
+	raw_distance = raw_distances[anchor_i, cols]
+	distance = abs_distances[anchor_i, cols]
 
-# import "division" allows decimals
-def calculate_overlap(anno_dict):
-    """ Calculates percentage of length covered by the peak/feature """
-    
-    #beds exclude first position, therefore +1 for starts. Range excludes last position in range - therefore +1 for end
-    ovl_range = range(max(anno_dict["peak_start"]+1, anno_dict["feat_start"]+1), min(anno_dict["peak_end"], anno_dict["feat_end"])+1)
-    ovl_bp = len(ovl_range)
+	return(raw_distance, distance, anchor_i)
 
-    ovl_pk = ovl_bp / float(anno_dict["peak_length"])
-    ovl_feat = ovl_bp / float(anno_dict["feat_length"])
 
-    anno_dict["feat_ovl_peak"] = decimal_round(ovl_pk, 3)    #Percentage of the peak that is covered by the feature (1.0 corresponds to the genomic_location “PeakInsideFeature”). 
-    anno_dict["peak_ovl_feat"] = decimal_round(ovl_feat, 3)	 #Percentage of the feature that is covered by the peak (1.0 corresponds to the genomic_location “FeatureInsidePeak”).
+ANCHOR_CODES = {"start": 0, "center": 1, "end": 2}	#integer codes of anchors for the jit kernel
 
-    return(anno_dict)
+def init_jit_kernel():
+	""" Import numba and build/warm the jit-compiled scoring kernel on first use.
 
+		Called once per (worker) process before peaks are annotated; sets _NUMBA_AVAILABLE so that
+		annotate_single_peak can pick the kernel or the numpy fallback. """
 
-def get_relative_location(anno_dict):
-	""" Sets the relative location of peak to feature """
+	global _NUMBA_AVAILABLE, _score_candidates_kernel
+	if _NUMBA_AVAILABLE is not None:
+		return 	#already resolved for this process
 
-	location = "NA"
-	if float(anno_dict["feat_ovl_peak"]) == 1:
-		location = "PeakInsideFeature"
+	try:
+		import numba
+	except ImportError:
+		_NUMBA_AVAILABLE = False
+		return
+
+	@numba.njit(cache=True)
+	def kernel(fs, fe, minus, plus, peak_start, peak_end, peak_center, peak_length, anchor_codes, dist_lo, dist_hi):
+		""" Jit-compiled fusion of score_candidates, the distance bounds check, calculate_overlap and
+			get_relative_location into a single pass over the candidate slice.
+
+			fs/fe/minus/plus are the start/end/strand columns of the candidate slice; anchor_codes
+			holds the allowed anchors as integers (see ANCHOR_CODES); dist_lo/dist_hi are the two
+			values of query["distance"].
+
+			Returns (raw_distance, distance, anchor_i, dist_ok, feat_ovl_peak, peak_ovl_feat, loc_codes). """
+
+		n = len(fs)
+		n_anchors = len(anchor_codes)
+		raw_distance = np.empty(n, dtype=np.int64)
+		distance = np.empty(n, dtype=np.int64)
+		anchor_i = np.empty(n, dtype=np.int8)
+		dist_ok = np.empty(n, dtype=np.bool_)
+		feat_ovl_peak = np.empty(n, dtype=np.float64)
+		peak_ovl_feat = np.empty(n, dtype=np.float64)
+		loc_codes = np.empty(n, dtype=np.int8)
+
+		for i in range(n):
+
+			#Set minimum distance as best anchor (first anchor in anchor_codes wins ties)
+			best_raw, best_abs, best_k = 0, -1, 0
+			for k in range(n_anchors):
+				code = anchor_codes[k]
+				if code == 0:	#start anchor; direction of transcription
+					pos = fe[i] if minus[i] else fs[i]
+				elif code == 1:	#center anchor
+					pos = fs[i] + (fe[i] - fs[i]) // 2	#avoids int32 overflow of fs+fe for large coordinates
+				else:			#end anchor; direction of transcription
+					pos = fs[i] if minus[i] else fe[i]
+
+				raw = peak_center - pos
+				absolute = -raw if raw < 0 else raw
+				if best_abs < 0 or absolute < best_abs:
+					best_raw, best_abs, best_k = raw, absolute, k
+
+			raw_distance[i] = best_raw
+			distance[i] = best_abs
+			anchor_i[i] = best_k
+
+			#Check whether distance is within the valid range for this candidate
+			if plus[i]:
+				dist_ok[i] = best_raw > -dist_lo and best_raw < dist_hi
+			else:
+				dist_ok[i] = best_raw > -dist_hi and best_raw < dist_lo
+
+			#Overlap fractions between peak and feature
+			ovl_bp = min(peak_end, fe[i]) - max(peak_start, fs[i])
+			if ovl_bp < 0:
+				ovl_bp = 0
+			fop = ovl_bp / peak_length
+			pof = ovl_bp / (fe[i] - fs[i])
+			feat_ovl_peak[i] = fop
+			peak_ovl_feat[i] = pof
+
+			#Relative location of peak to feature; overlap fractions are compared at output precision
+			#(np.rint(x*1000) mirrors np.round(x, 3) as used by the numpy path)
+			start_anchor = fe[i] if minus[i] else fs[i]
+			end_anchor = fs[i] if minus[i] else fe[i]
+			if np.rint(fop * 1000.0) == 1000.0:
+				loc_codes[i] = 1	#PeakInsideFeature
+			elif np.rint(pof * 1000.0) == 1000.0:
+				loc_codes[i] = 2	#FeatureInsidePeak
+			elif ovl_bp == 0:
+				peak_after = best_raw > 0	#whether peak center is beyond the chosen anchor
+				loc_codes[i] = 3 if peak_after == minus[i] else 4	#Upstream/Downstream
+			elif start_anchor > peak_start and start_anchor <= peak_end:
+				loc_codes[i] = 5	#OverlapStart
+			elif end_anchor > peak_start and end_anchor <= peak_end:
+				loc_codes[i] = 6	#OverlapEnd
+			else:
+				loc_codes[i] = 0	#NA
 
-	elif float(anno_dict["peak_ovl_feat"]) == 1:
-		location = "FeatureInsidePeak"
+		return(raw_distance, distance, anchor_i, dist_ok, feat_ovl_peak, peak_ovl_feat, loc_codes)
 
-	elif float(anno_dict["feat_ovl_peak"]) == 0: #no overlap
-		
-		#If feature (gene) is on the - strand
-		if anno_dict["feat_strand"] == "-":
-			
-			#Check if peak is upstream/downstream of anchor
-			if anno_dict["peak_center"] > anno_dict["anchor_pos"][anno_dict["feat_anchor"]]:
-				location = "Upstream" #For feature strand '-': If peak_center is higher than the anchor, the peak is upstream
-			else:
-				location = "Downstream"
+	#Warm with dummy input (compile or load from the jit cache) so compilation never hits the first peak
+	dummy_start = np.zeros(1, dtype=np.int32)
+	dummy_end = np.ones(1, dtype=np.int32)
+	dummy_strand = np.zeros(1, dtype=bool)
+	kernel(dummy_start, dummy_end, dummy_strand, dummy_strand, 0, 1, 0, 1, np.zeros(1, dtype=np.int8), 0, 0)
 
-		#Else, feature must be on the plus strand
-		else:
-			#Check if peak is upstream/downstream of anchor
-			if anno_dict["peak_center"] > anno_dict["anchor_pos"][anno_dict["feat_anchor"]]:
-				location = "Downstream" #For feature strand '+': If peak_center is higher than the anchor, the peak is downstream
-			else:
-				location = "Upstream"
-	
-	else:	#some overlap, but not completely internal
+	_score_candidates_kernel = kernel
+	_NUMBA_AVAILABLE = True
 
-		#Figure out if it is overlapstart or overlap end
-		if anno_dict["anchor_pos"]["start"] in range(anno_dict["peak_start"]+1, anno_dict["peak_end"]+1):
-			location = "OverlapStart"
 
-		elif anno_dict["anchor_pos"]["end"] in range(anno_dict["peak_start"]+1, anno_dict["peak_end"]+1):
-			location = "OverlapEnd"
+def calculate_overlap(peak_start, peak_end, peak_length, chrom_feats, idx):
+	""" Calculates percentage of length covered by the peak/feature for a whole slice of candidate records at once.
 
-	anno_dict["relative_location"] = location
+		Returns:
+			(feat_ovl_peak, peak_ovl_feat): numpy arrays over the candidates.
+										    feat_ovl_peak is the fraction of the peak that is covered by the feature (1.0 corresponds to the genomic_location “PeakInsideFeature”).
+										    peak_ovl_feat is the fraction of the feature that is covered by the peak (1.0 corresponds to the genomic_location “FeatureInsidePeak”).
+	"""
 
-	return(anno_dict)
+	fs = chrom_feats.starts[idx]
+	fe = chrom_feats.ends[idx]
 
+	#Number of overlapping basepairs between peak and feature
+	ovl_bp = np.maximum(0, np.minimum(peak_end, fe) - np.maximum(peak_start, fs))
 
-def annotate_single_peak(peak, tabix_obj, cfg_dict, logger=None):
-	""" 
-	Annotates a single peak against tabix_obj (GTF) using the configuration in queries
+	feat_ovl_peak = ovl_bp / float(peak_length)
+	peak_ovl_feat = ovl_bp / (fe - fs).astype(float)
+
+	return(feat_ovl_peak, peak_ovl_feat)
+
+
+#Relative locations by integer code; codes are only converted to labels at output time
+LOCATION_LABELS = ["NA", "PeakInsideFeature", "FeatureInsidePeak", "Upstream", "Downstream", "OverlapStart", "OverlapEnd"]
+LOCATION_CODES = {label: code for code, label in enumerate(LOCATION_LABELS)}
+
+def get_relative_location(peak_start, peak_end, peak_center, chrom_feats, idx, raw_distance, feat_ovl_peak, peak_ovl_feat):
+	""" Sets the relative location of peak to feature for a whole slice of candidate records at once.
+
+		Locations are established from boolean masks over the candidate columns instead of per-hit
+		branching; the first matching mask wins, mirroring the original if/elif chain.
+
+		Returns:
+			loc_codes (np.ndarray): int8 codes per candidate, indexing into LOCATION_LABELS
+	"""
+
+	fs = chrom_feats.starts[idx]
+	fe = chrom_feats.ends[idx]
+	minus = chrom_feats.strand_minus[idx]
+
+	anchor_pos = peak_center - raw_distance 	#position of the chosen anchor per candidate
+	start_anchor = np.where(minus, fe, fs)		#"start"/"end" refer to the direction of transcription
+	end_anchor = np.where(minus, fs, fe)
+
+	#The overlap fractions are compared on output precision (3 decimals), as previously done on the rounded output values
+	inside_feature = np.round(feat_ovl_peak, 3) == 1
+	inside_peak = np.round(peak_ovl_feat, 3) == 1
+	no_overlap = feat_ovl_peak == 0
+	peak_after = peak_center > anchor_pos 	#whether peak center is downstream (+) / upstream (-) of the anchor
+
+	conditions = [inside_feature,
+					inside_peak,
+					no_overlap & (peak_after == minus),							#peak on the upstream side of the anchor
+					no_overlap,													#remaining non-overlapping hits are downstream
+					(start_anchor > peak_start) & (start_anchor <= peak_end),	#partial overlap across the feature start
+					(end_anchor > peak_start) & (end_anchor <= peak_end)]		#partial overlap across the feature end
+	choices = [LOCATION_CODES[label] for label in ["PeakInsideFeature", "FeatureInsidePeak", "Upstream", "Downstream", "OverlapStart", "OverlapEnd"]]
+	loc_codes = np.select(conditions, choices, default=LOCATION_CODES["NA"]).astype(np.int8)
+
+	return(loc_codes)
+
+
+def annotate_single_peak(peak, chrom_feats, cfg_dict, logger=None):
+	"""
+	Annotates a single peak against the in-memory GTF records of its chromosome using the configuration in queries
 
 	Input:
 		peak (dict): A dictionary containing information on peak. It has the form: {"peak_chr":"chr1", "peak_start":0, "peak_end":100, "peak_id":"peak1", "peak_score":0.4, "peak_strand":"+"}
 					 This dict can also include gtf_chr in case the gtf has a different chromosome prefix, e.g.: { (...), "gtf_chr":1}
 					 It might also contain other information such as: { (...), "additional_bed_column_1":"column_value"}
-		tabix_obj (Pysam TabixFile): tabix_obj is an open pysam.TabixFile
+		chrom_feats (ChromFeatures): The loaded GTF records for the chromosome of the peak. An open pysam.TabixFile of the .gtf-file is also accepted and loaded internally.
 		cfg_dict (dict): Configuration dictionary containing "queries" and "priority" keys
 		logger (python.logging obj): Logger object for debugging or None
 
@@ -175,6 +417,10 @@ def annotate_single_peak(peak, tabix_obj, cfg_dict, logger=None):
 								  If no hits were found, the peak is returned without annotation information.
 	"""
 
+	#Backwards compatibility: callers can still pass an open pysam tabix handle instead of loaded records
+	if isinstance(chrom_feats, pysam.TabixFile):
+		chrom_feats = ChromFeatures(chrom_feats, peak.get("gtf_chr", peak["peak_chr"]))
+
 	#General info on queries
 	queries = cfg_dict["queries"]
 	n_queries = len(queries)
@@ -182,7 +428,11 @@ def annotate_single_peak(peak, tabix_obj, cfg_dict, logger=None):
 	max_distance = int(max(distances))
 
 	#Annotation
+	debug2 = logger.isEnabledFor(logging.DEBUG - 5)	#timings/per-hit messages are only built when deep debugging is on
 	logger.debug2("Annotating peak: {0}".format(peak))
+	peak_center = int((peak["peak_end"] + peak["peak_start"])/2.0)
+	peak_length = peak["peak_end"] - peak["peak_start"]
+	peak_strand = peak["peak_strand"]
 
 	valid_annotations = []	#for this peak
 	stop_searching = False
@@ -194,92 +444,124 @@ def annotate_single_peak(peak, tabix_obj, cfg_dict, logger=None):
 
 		logger.debug2("Finding hits for query: {0}".format(query))
 
-		#Extend and fetch possible hits from tabix
+		#Extend peak with max_distance and fetch possible hits from the chromosome features
 		max_distance = max(query["distance"])
 		extend_start = int(max(1, peak["peak_start"] - max_distance))
 		extend_end = peak["peak_end"] + max_distance
-		tabix_query = "{0}:{1}-{2}".format(peak.get("gtf_chr", peak["peak_chr"]), extend_start, extend_end)
-		logger.debug2("Tabix query for query {0} ({1}): {2}".format(query_i, query["name"], tabix_query))
+		logger.debug2("Fetch window for query {0} ({1}): {2}-{3}".format(query_i, query["name"], extend_start, extend_end))
+
+		if debug2:
+			begin = time.perf_counter_ns()
+		idx = chrom_feats.fetch_idx(extend_start, extend_end)	#candidate record indices for this query
+		if debug2:
+			logger.debug2("Fetched {0} hits in {1}s".format(len(idx), (time.perf_counter_ns() - begin)/1e9))
+			begin = time.perf_counter_ns()
+
+		#Hoist invariant query parameters to locals; these do not change per candidate
+		q_name = query["name"]
+		q_dist_lo, q_dist_hi = query["distance"]
+		q_anchor = frozenset(query.get("feature_anchor", []))	#for membership checks only; ordering comes from the query list
+		q_strand = query.get("strand", "ignore")
+		check_strand = q_strand != "ignore" and peak["peak_strand"] != "."
+		q_internals = query.get("internals", 0) * 1.0
+		q_loc_codes = frozenset([LOCATION_CODES[label] for label in query["relative_location"]]) if "relative_location" in query else None
+		if "filter_attribute" in query and "attribute_values" in query:
+			q_filter_attr = query["filter_attribute"]
+			q_attr_values = frozenset(query["attribute_values"])	#constant-time membership regardless of list size
+		else:
+			q_filter_attr, q_attr_values = None, None
+
+		#If feature is not the right one, we do not have to go further - saves computation of distances
+		if "feature" in query:
+			wanted_ids = [chrom_feats.feature_index[feature] for feature in query["feature"] if feature in chrom_feats.feature_index]
+			idx = idx[np.isin(chrom_feats.feature_ids[idx], wanted_ids)]
+
+		#Calculate distances/anchors, overlap fractions and relative locations for all candidates at once
+		anchor_list = query.get("feature_anchor") or ["start", "center", "end"]	#keep the configured order so distance ties resolve deterministically
+		if _NUMBA_AVAILABLE:
+			#Fused kernel: one pass over the candidate slice computes all per-candidate values
+			anchor_codes = np.array([ANCHOR_CODES[anchor] for anchor in anchor_list], dtype=np.int8)
+			(raw_distance, distance, anchor_i, dist_ok,
+				feat_ovl_peak, peak_ovl_feat, loc_codes) = _score_candidates_kernel(chrom_feats.starts[idx], chrom_feats.ends[idx],
+																					chrom_feats.strand_minus[idx], chrom_feats.strand_plus[idx],
+																					peak["peak_start"], peak["peak_end"], peak_center, peak_length,
+																					anchor_codes, q_dist_lo, q_dist_hi)
+		else:
+			raw_distance, distance, anchor_i = score_candidates(peak_center, chrom_feats, idx, anchor_list)
+			plus = chrom_feats.strand_plus[idx]
+			dist_ok = np.where(plus, (raw_distance > -q_dist_lo) & (raw_distance < q_dist_hi),
+										(raw_distance > -q_dist_hi) & (raw_distance < q_dist_lo))
+			feat_ovl_peak, peak_ovl_feat = calculate_overlap(peak["peak_start"], peak["peak_end"], peak_length, chrom_feats, idx)
+			loc_codes = get_relative_location(peak["peak_start"], peak["peak_end"], peak_center, chrom_feats, idx, raw_distance, feat_ovl_peak, peak_ovl_feat)
+
+		#Establish which candidates can still become valid hits with cheap vectorized prescreens;
+		#the scalar loop below (and the annotation dicts) is only entered for the plausible minority
+		if q_internals > 0:
+			candidate_mask = dist_ok | (np.maximum(feat_ovl_peak, peak_ovl_feat) > 0)	#only overlapping hits can override the distance check
+		else:
+			candidate_mask = dist_ok.copy()
 
-		try:
-			begin = datetime.datetime.now()
-			hits = list(tabix_obj.fetch(tabix_query, parser=pysam.asGTF()))	#hits for this query
-			end = datetime.datetime.now()
-			logger.debug2("Fetched {0} hits in {1}".format(len(hits), end - begin))
-		except: 
-			#exception if no hits could be fetched from tabix, for example if the contig does not exist in the gtf index.
-			#print("ERROR: Could not create iterator for peak: {0} \n with tabix query {1}".format(peak, tabix_query))		
-			stop_searching = True 
-			hits = []
-
-		begin = datetime.datetime.now()
-		for hit in hits: 
-			
-			#If feature is not the right one, we do not have to go further - saves computation of distances
-			if "feature" in query:
-				if hit.feature not in query["feature"]:
-					#logger.debug("{0} not in {1} - continuing to next hit".format(hit.feature, query["feature"]))
-					continue
-
-			anno_dict = create_anno_dict(peak, hit)
-			anno_dict["query"] = query_i
-			anno_dict["query_name"] = query["name"]
-
-			#Calculate distances/relative location
-			anno_dict = distance_to_peak_center(anno_dict, query.get("feature_anchor", []))
-			anno_dict = calculate_overlap(anno_dict)
-			anno_dict = get_relative_location(anno_dict)
+		#Peak strand relative to feature strand
+		if check_strand:
+			if q_strand == "same":
+				candidate_mask &= chrom_feats.strand_plus[idx] if peak_strand == "+" else chrom_feats.strand_minus[idx]
+			elif q_strand == "opposite":
+				candidate_mask &= ~(chrom_feats.strand_plus[idx] if peak_strand == "+" else chrom_feats.strand_minus[idx])
+			else:	#q_strand is '+'/'-'; the check does not depend on the candidate
+				candidate_mask &= peak_strand == q_strand
+
+		#Filter on relative location
+		if q_loc_codes is not None:
+			candidate_mask &= np.isin(loc_codes, list(q_loc_codes))
+
+		candidates = np.nonzero(candidate_mask)[0]
+
+		for j in candidates:
+			i = idx[j]	#index of the candidate record within chrom_feats
 
 			##### Test validity of the hit to query_i ####
 			checks = {}
-			#if "feature" in query:
-			#	checks["feature"] = anno_dict["feature"] in query["feature"]	 #feature
 
 			#Check feature anchor
-			if "feature_anchor" in query:
-				checks["feature_anchor"] = anno_dict["feat_anchor"] in query["feature_anchor"]
-
-			#Peak strand relative to feature strand
-			if "strand" in query:
-				if query["strand"] != "ignore" and anno_dict["peak_strand"] != ".":
-					checks["strand"] = ((anno_dict["peak_strand"] == query["strand"]) or
-										(anno_dict["peak_strand"] == anno_dict["feat_strand"] and query["strand"] == "same") or 
-										(anno_dict["peak_strand"] != anno_dict["feat_strand"] and query["strand"] == "opposite"))	
-
-			#Check whether distance was valid
-			if anno_dict["feat_strand"] == "+":
-				checks["distance"] = anno_dict["raw_distance"] > -query["distance"][0] and anno_dict["raw_distance"] < query["distance"][1]
-			else:
-				checks["distance"] = anno_dict["raw_distance"] > -query["distance"][1] and anno_dict["raw_distance"] < query["distance"][0]
+			if q_anchor:
+				checks["feature_anchor"] = anchor_list[anchor_i[j]] in q_anchor
+
+			#Whether distance was valid (precalculated above)
+			checks["distance"] = bool(dist_ok[j])
 
 			#Check distance (Distance can still be valid if PeakInsideFeature/FeatureInsidePeak and internals flag is set)
-			if "internals" in query:
-				max_overlap = max(float(anno_dict["feat_ovl_peak"]), float(anno_dict["peak_ovl_feat"]))
-				checks["distance"] = checks["distance"] or (query["internals"]*1.0 > 0 and max_overlap >= query["internals"]*1.0)	#if internals is set to more than 0 overlap
-
-			#Filter on relative location
-			if "relative_location" in query:
-				checks["relative_location"] = anno_dict["relative_location"] in query["relative_location"]
-			
+			if q_internals > 0 and not checks["distance"]:
+				max_overlap = max(float(decimal_round(feat_ovl_peak[j], 3)), float(decimal_round(peak_ovl_feat[j], 3)))	#compared at output precision as previously
+				checks["distance"] = max_overlap >= q_internals
+
 			#Filter on attribute if any was set
-			if "filter_attribute" in query and "attribute_values" in query: #query["filter_attribute"] != None:
+			if q_attr_values is not None:
 
 				#Check if the desired filter attribute is in the attributes of the hit:
-				checks["attribute"] = False
-				if query["filter_attribute"] in anno_dict["feat_attributes"]:
-					for filter_value in query["attribute_values"]:
-						tag_values_list = anno_dict["feat_attributes"][query["filter_attribute"]]	#list of values for this tag
-						if filter_value in tag_values_list:
-							checks["attribute"] = True
-			
+				tag_values_list = parse_attributes(chrom_feats.attributes[i]).get(q_filter_attr)	#list of values for this tag or None
+				checks["attribute"] = tag_values_list is not None and not q_attr_values.isdisjoint(tag_values_list)
+
 			##### All checks are done -> establish if hit is a valid annotation #####
-			valid = sum(checks.values()) == len(checks.values()) #all checks must be valid
+			valid = all(checks.values()) #all checks must be valid; short-circuits on the first False
 			if valid:
-				valid_annotations.append(anno_dict.copy())
-			logger.debug2("Validity: {0} | Checks: {1} | Annotation dict: {2}".format(valid, checks, {key:anno_dict[key] for key in anno_dict}))
-		
-		end = datetime.datetime.now()
-		logger.debug2("Validated hits in {0}".format(end-begin))
+
+				#The annotation dict is only materialized for hits which passed all checks
+				anno_dict = create_anno_dict(peak, chrom_feats.record(i), peak_center, peak_length)
+				anno_dict["query"] = query_i
+				anno_dict["query_name"] = q_name
+				anno_dict["raw_distance"] = int(raw_distance[j])
+				anno_dict["distance"] = int(distance[j])
+				anno_dict["feat_anchor"] = anchor_list[anchor_i[j]]
+				anno_dict["feat_ovl_peak"] = decimal_round(feat_ovl_peak[j], 3)
+				anno_dict["peak_ovl_feat"] = decimal_round(peak_ovl_feat[j], 3)
+				anno_dict["relative_location"] = LOCATION_LABELS[loc_codes[j]]
+				valid_annotations.append(anno_dict)
+
+			if debug2:
+				logger.debug2("Validity: {0} | Checks: {1} | Candidate: record {2} with distance {3}".format(valid, checks, i, distance[j]))
+
+		if debug2:
+			logger.debug2("Validated hits in {0}s".format((time.perf_counter_ns() - begin)/1e9))
 
 		#All tabix hits for this query were checked - if priority, stop searching if any valid hit was found -> else, check next query
 		stop_searching = (len(valid_annotations) > 0 and cfg_dict["priority"]) or stop_searching #or if stop_searching was already set previously
@@ -304,7 +586,7 @@ def annotate_single_peak(peak, tabix_obj, cfg_dict, logger=None):
 		#	valid_annotations = [anno_dict for anno_dict in valid_annotations if anno_dict["query"] == highest_priority_query]
 
 		distances = [anno_dict["distance"] for anno_dict in valid_annotations]
-		best_hit_index = distances.index(min(distances))
+		best_hit_index = int(np.argmin(distances))	#one pass; first minimum wins as before
 		valid_annotations[best_hit_index]["best_hit"] = 1
 
 	else:
@@ -346,39 +628,70 @@ def annotate_peaks(peaks, gtf_gz, gtf_index, cfg_dict, q, idx, attributes, logge
 
 	logger = UROPALogger(**logger_options)
 
+	#Import numba and warm the jit kernel up front; deferred from module import to keep CLI startup fast
+	init_jit_kernel()
+
 	#Open tabix file
 	tabix_obj = pysam.TabixFile(gtf_gz, index=gtf_index)
 
-	#For each peak in input peaks, collect all_valid_annotations
+	#Group peak indices per chromosome; the gtf records of each chromosome are loaded only once
+	chrom_order = []	#order of first occurrence
+	chrom_to_peak_i = {}
+	for i, peak in enumerate(peaks):
+		chrom = peak.get("gtf_chr", peak["peak_chr"])
+		if chrom not in chrom_to_peak_i:
+			chrom_to_peak_i[chrom] = []
+			chrom_order.append(chrom)
+		chrom_to_peak_i[chrom].append(i)
+
+	#For each peak in input peaks, stream annotations directly into formatted output rows;
+	#this bounds the chunk memory to the output text instead of keeping every annotation dict
 	logger.debug("Annotating peaks in chunk {0}".format(idx))
-	all_valid_annotations = []
-	for peak in peaks:
-		
-		#Annotate single peak
-		valid_annotations = annotate_single_peak(peak, tabix_obj, cfg_dict, logger=logger)
-		all_valid_annotations.extend(valid_annotations)
+	query_names = [query["name"] for query in cfg_dict["queries"]] if cfg_dict["output_by_query"] == True else []
+	rows_per_peak = [None] * len(peaks)
+	for chrom in chrom_order:
+
+		#Load all gtf records of this chromosome into memory (or reuse the worker cache)
+		chrom_feats = get_chrom_features(tabix_obj, gtf_gz, chrom)
+		logger.debug2("Loaded {0} gtf records for chromosome {1}".format(chrom_feats.n, chrom))
+
+		#Annotate single peaks against the loaded records
+		for i in chrom_to_peak_i[chrom]:
+			valid_annotations = annotate_single_peak(peaks[i], chrom_feats, cfg_dict, logger=logger)
+
+			#Convert annotations to output rows right away; the dicts are dropped with the next peak
+			all_rows = [annopeak_to_string(anno, attributes=attributes) for anno in valid_annotations]
+			final_rows = [row for row, anno in zip(all_rows, valid_annotations) if anno.get("best_hit", 0) == 1]
+			if len(query_names) > 0:
+				query_rows = {name: [] for name in query_names}
+				for row, anno in zip(all_rows, valid_annotations):
+					name = anno.get("query_name", "")
+					if name in query_rows:
+						query_rows[name].append(row)
+			else:
+				query_rows = None
+
+			rows_per_peak[i] = (all_rows, final_rows, query_rows)
 
 	tabix_obj.close()
 
-	#Write annotations to best hits and final hits
+	#Write annotations to best hits and final hits (in the original peak order)
 	logger.debug("Annotated all peaks in chunk {0}. Now adding contents to queue...".format(idx))
-	content = "\n".join([annopeak_to_string(peak, attributes=attributes) for peak in all_valid_annotations]) + "\n"
+	content = "\n".join([row for rows in rows_per_peak for row in rows[0]]) + "\n"
 	q.put(("allhits.bed", idx, content))
 	q.put(("allhits.txt", idx, content))
 	content = ""
-	
-	finalhits_content = "\n".join([annopeak_to_string(peak, attributes=attributes) for peak in all_valid_annotations if peak.get("best_hit", 0) == 1]) + "\n"
+
+	finalhits_content = "\n".join([row for rows in rows_per_peak for row in rows[1]]) + "\n"
 	q.put(("finalhits.bed", idx, finalhits_content))
 	q.put(("finalhits.txt", idx, finalhits_content))
 	finalhits_content = ""
-	
+
 	## Hits per query if chosen
-	if cfg_dict["output_by_query"] == True:
-		query_names = [query["name"] for query in cfg_dict["queries"]]
-		for name in query_names:
-			query_str = "\n".join([annopeak_to_string(peak, attributes=attributes) for peak in all_valid_annotations if peak.get("query_name", "") == name]) + "\n"
-			q.put((name + ".bed", idx, query_str))
-			q.put((name + ".txt", idx, query_str))
+	for name in query_names:
+		query_str = "\n".join([row for rows in rows_per_peak for row in rows[2][name]]) + "\n"
+		q.put((name + ".bed", idx, query_str))
+		q.put((name + ".txt", idx, query_str))
 
 	logger.debug("Job finished for chunk {0}".format(idx))
 	return(0) #success